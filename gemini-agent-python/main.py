@@ -1,19 +1,109 @@
 from google import genai
 from google.genai import types
 import os
+import asyncio
+import threading
 import sys
+import time
+import argparse
+import importlib.util
 from pathlib import Path
 import traceback
+import httpx
+from concurrent.futures import ThreadPoolExecutor
 # Placeholder imports for tool functions (to be implemented in tools.py)
 from tools import read_file, list_files, edit_file, execute_bash_command, run_in_sandbox
 
 # Choose your Gemini model
 MODEL_NAME = "gemini-2.0-flash"
 
+# Context window of MODEL_NAME, and the share of it at which the conversation
+# is summarized and restarted
+MODEL_CONTEXT_LIMIT = 1_048_576
+SUMMARIZE_THRESHOLD = 0.6
+SUMMARY_PROMPT = ("Summarize the conversation so far in at most 500 tokens so "
+                  "that it can be continued from the summary alone. Include "
+                  "files touched and open tasks. Do not call any tools.")
+
+# Batch job polling
+BATCH_POLL_INTERVAL = 10  # seconds
+BATCH_DONE_STATES = {"JOB_STATE_SUCCEEDED", "JOB_STATE_FAILED",
+                     "JOB_STATE_CANCELLED", "JOB_STATE_EXPIRED"}
+
+# Number of most recent conversation turns whose tool calls are kept verbatim
+PRUNE_KEEP_TURNS = 2
+
+# Explicit context cache for the static tool schema prefix. The API rejects
+# caches below a per-model minimum size (4096 tokens for gemini-2.0-flash).
+CACHE_TTL_SECONDS = 3600
+CACHE_MIN_TOKENS = 4096
+CHARS_PER_TOKEN = 4  # Rough size estimate, avoids a count_tokens round-trip
+
+# Tool calls: read-only tools requested together run concurrently on this pool
+TOOL_POOL = ThreadPoolExecutor(max_workers=8, thread_name_prefix="tool")
+PARALLEL_SAFE_TOOLS = {"read_file", "list_files"}
+MAX_TOOL_ROUNDS = 10  # Same bound as the SDK's automatic function calling
+
 # Define project root
 project_root = Path(__file__).resolve().parent
 
 
+def _http_options() -> types.HttpOptions:
+    """Keeps pooled connections alive between turns, over HTTP/2 when h2 is installed."""
+    client_args = {
+        "limits": httpx.Limits(max_keepalive_connections=8, keepalive_expiry=300)
+    }
+    if importlib.util.find_spec("h2") is not None:
+        client_args["http2"] = True
+    return types.HttpOptions(
+        client_args=client_args, async_client_args=dict(client_args))
+
+
+def _is_user_prompt(content) -> bool:
+    """True for a user-typed message, as opposed to tool responses sent back."""
+    parts = content.parts or []
+    return (content.role == "user"
+            and any(part.text for part in parts)
+            and not any(part.function_response for part in parts))
+
+
+def _chunk_text(chunk) -> str:
+    """Joins a streamed chunk's text parts.
+
+    Unlike chunk.text this does not warn when the chunk also carries
+    function calls, so text sharing a chunk with a call is kept.
+    """
+    if not chunk.candidates or not chunk.candidates[0].content:
+        return ""
+    return "".join(part.text for part in chunk.candidates[0].content.parts or []
+                   if part.text and not part.thought)
+
+
+async def _read_input(prompt_text: str) -> str:
+    """Reads a line from stdin without blocking the event loop.
+
+    Uses a daemon thread rather than asyncio.to_thread so that Ctrl-C at the
+    prompt does not leave the interpreter waiting on a blocked input() call.
+    """
+    loop = asyncio.get_running_loop()
+    future = loop.create_future()
+
+    def settle(setter, value):
+        if not future.done():
+            setter(value)
+
+    def read():
+        try:
+            line = input(prompt_text)
+        except BaseException as e:
+            loop.call_soon_threadsafe(settle, future.set_exception, e)
+        else:
+            loop.call_soon_threadsafe(settle, future.set_result, line)
+
+    threading.Thread(target=read, daemon=True).start()
+    return await future
+
+
 class CodeAgent:
     """A simple coding agent using Google Gemini (google-genai SDK)."""
 
@@ -27,74 +117,402 @@ class CodeAgent:
             execute_bash_command,
             run_in_sandbox
         ]
+        self._tool_map = {func.__name__: func for func in self.tool_functions}
         self.client = None
         self.chat = None
-        self.conversation_history = []  # Manual history for token counting ONLY
+        # Manual history for fallback token counting ONLY, kept as plain
+        # ContentDicts; count_tokens accepts them without building models
+        self.conversation_history = []
         self.current_token_count = 0  # Store token count for the next prompt
+        self._token_cache = {}  # id(content) -> token count, counted once
+        self.cache_name = None  # Cached tool schemas, if the API accepted them
+        self._cache_expires_at = 0.0
+        self._warm_up_task = None
+        self.tool = None  # Tool schemas, built once from tool_functions
+        self.tool_config = None  # Per-request config, built once
         self._configure_client()
 
     def _configure_client(self):
         print("\n⚒️ Configuring genai client...")
         try:
-            self.client = genai.Client(api_key=self.api_key)
+            self.client = genai.Client(
+                api_key=self.api_key, http_options=_http_options())
             print("✅ Client configured successfully.")
         except Exception as e:
             print(f"❌ Error configuring genai client: {e}")
             traceback.print_exc()
             sys.exit(1)
+        # Introspect the tool functions into declarations once, rather than
+        # letting the SDK re-derive the schemas from the callables per request
+        self.tool = types.Tool(function_declarations=[
+            types.FunctionDeclaration.from_callable_with_api_option(
+                callable=func, api_option='GEMINI_API')
+            for func in self.tool_functions
+        ])
+        self._create_prompt_cache()
+        self.tool_config = self._build_tool_config()
+
+    def _no_function_calling_config(self) -> types.GenerateContentConfig:
+        # Tools stay declared (the history holds function calls) but the
+        # model may not call them. Never uses the cache, which can't carry
+        # a tool_config override.
+        return types.GenerateContentConfig(
+            tools=[self.tool],
+            tool_config=types.ToolConfig(
+                function_calling_config=types.FunctionCallingConfig(mode="NONE")),
+            automatic_function_calling=types.AutomaticFunctionCallingConfig(
+                disable=True))
+
+    def _build_tool_config(self) -> types.GenerateContentConfig:
+        # Automatic function calling is disabled: the SDK would run a turn's
+        # tool calls one after another, so _call_tools dispatches them instead.
+        no_afc = types.AutomaticFunctionCallingConfig(disable=True)
+        if self.cache_name:
+            return types.GenerateContentConfig(
+                cached_content=self.cache_name,
+                automatic_function_calling=no_afc)
+        return types.GenerateContentConfig(
+            tools=[self.tool],
+            automatic_function_calling=no_afc)
+
+    def _create_prompt_cache(self):
+        """Uploads the tool schemas once as cached content, if the model allows it.
+
+        Falls back to sending tools with every request when caching is
+        unavailable (e.g. the prefix is below the model's minimum cache size).
+        """
+        # Estimate the prefix size locally so startup doesn't pay a round-trip
+        # for a cache that would be rejected as too small
+        prefix_json = self.tool.model_dump_json(exclude_none=True)
+        if len(prefix_json) // CHARS_PER_TOKEN < CACHE_MIN_TOKENS:
+            return
+        try:
+            cache = self.client.caches.create(
+                model=self.model_name,
+                config=types.CreateCachedContentConfig(
+                    tools=[self.tool],
+                    ttl=f"{CACHE_TTL_SECONDS}s"
+                )
+            )
+            self.cache_name = cache.name
+            self._cache_expires_at = time.monotonic() + CACHE_TTL_SECONDS
+            print("✅ Tool schemas cached.")
+        except Exception as e:
+            print(f"⚠️ Prompt caching unavailable, sending tools per request: {e}")
 
-    def start_interaction(self):
+    async def _refresh_prompt_cache(self):
+        """Extends the cache TTL once less than half of it remains."""
+        if not self.cache_name:
+            return
+        remaining = self._cache_expires_at - time.monotonic()
+        if remaining > CACHE_TTL_SECONDS / 2:
+            return
+        if remaining <= 0:
+            print("\n⚠️ Prompt cache expired, sending tools per request.")
+            self._drop_prompt_cache()
+            return
+        try:
+            await self.client.aio.caches.update(
+                name=self.cache_name,
+                config=types.UpdateCachedContentConfig(ttl=f"{CACHE_TTL_SECONDS}s")
+            )
+            self._cache_expires_at = time.monotonic() + CACHE_TTL_SECONDS
+        except Exception as e:
+            print(f"\n⚠️ Could not refresh prompt cache, sending tools per request: {e}")
+            self._drop_prompt_cache()
+
+    def _drop_prompt_cache(self):
+        """Stops referencing the cache so later turns send the tools inline."""
+        self.cache_name = None
+        self.tool_config = self._build_tool_config()
+
+    def close(self):
+        """Releases server-side resources held by the agent."""
+        if not self.cache_name:
+            return
+        try:
+            self.client.caches.delete(name=self.cache_name)
+        except Exception as e:
+            print(f"\n⚠️ Could not delete prompt cache: {e}")
+        self.cache_name = None
+
+    async def _call_tool(self, function_call) -> types.Part:
+        """Runs a model-requested tool call and wraps its result as a function response."""
+        func = self._tool_map.get(function_call.name)
+        if func is None:
+            result = f"Error: Unknown tool '{function_call.name}'."
+        else:
+            try:
+                loop = asyncio.get_running_loop()
+                result = await loop.run_in_executor(
+                    TOOL_POOL, lambda: func(**(function_call.args or {})))
+            except Exception as e:
+                result = f"Error: Tool '{function_call.name}' failed: {e}"
+        return types.Part.from_function_response(
+            name=function_call.name, response={"result": result})
+
+    async def _count_content_tokens(self, content) -> int:
+        """Returns the token count of a history entry, counting it only once."""
+        key = id(content)
+        if key not in self._token_cache:
+            token_count_response = await self.client.aio.models.count_tokens(
+                model=self.model_name,
+                contents=[content]
+            )
+            self._token_cache[key] = token_count_response.total_tokens
+        return self._token_cache[key]
+
+    def _forget_content_tokens(self, content):
+        """Evicts a history entry's cached token count once it leaves history."""
+        self._token_cache.pop(id(content), None)
+
+    def _prune_history(self):
+        """Replaces tool calls/outputs older than PRUNE_KEEP_TURNS turns with placeholders.
+
+        Old tool outputs (file contents, directory listings, container logs)
+        would otherwise be re-sent on every turn. The chat is only rebuilt
+        when something was actually elided.
+        """
+        history = self.chat.get_history()
+        # Count turns by user prompts, not entries: a streamed reply is
+        # recorded as one model entry per chunk.
+        cutoff = None
+        turns = 0
+        for index in range(len(history) - 1, -1, -1):
+            if _is_user_prompt(history[index]):
+                turns += 1
+                if turns == PRUNE_KEEP_TURNS:
+                    cutoff = index
+                    break
+        if not cutoff:
+            return
+        pruned = False
+        new_history = []
+        for index, content in enumerate(history):
+            if index >= cutoff or not any(
+                    part.function_call or part.function_response
+                    for part in content.parts or []):
+                new_history.append(content)
+                continue
+            parts = []
+            for part in content.parts:
+                if part.function_call:
+                    parts.append(types.Part(
+                        text=f"[called tool {part.function_call.name}]"))
+                elif part.function_response:
+                    parts.append(types.Part(
+                        text=f"[{part.function_response.name} output elided]"))
+                else:
+                    parts.append(part)
+            new_history.append(types.Content(parts=parts, role=content.role))
+            pruned = True
+        if pruned:
+            self.chat = self.client.aio.chats.create(
+                model=self.model_name, history=new_history)
+
+    async def _call_tools(self, function_calls) -> list:
+        """Runs a turn's tool calls, overlapping adjacent read-only ones.
+
+        Tools with side effects run one at a time in the order requested, so
+        e.g. an edit_file followed by read_file still sees the new content.
+        """
+        parts = []
+        index = 0
+        while index < len(function_calls):
+            end = index + 1
+            if function_calls[index].name in PARALLEL_SAFE_TOOLS:
+                while (end < len(function_calls)
+                       and function_calls[end].name in PARALLEL_SAFE_TOOLS):
+                    end += 1
+            parts.extend(await asyncio.gather(
+                *(self._call_tool(call) for call in function_calls[index:end])))
+            index = end
+        return parts
+
+    async def _stream_reply(self, user_input: str, config):
+        """Streams the agent's reply to stdout as it arrives.
+
+        Returns the final chunk (which carries usage metadata) and the reply
+        reassembled into a single content dict for the manual history.
+        """
+        last_chunk = None
+        text_parts = []
+        message = user_input
+        # On failure, restore the chat to its pre-turn state so it never ends
+        # in a function call that has no matching function response
+        history_before = list(self.chat.get_history())
+        sys.stdout.write("\n🟢 \x1b[92mAgent:\x1b[0m ")
+        try:
+            for tool_round in range(MAX_TOOL_ROUNDS + 2):
+                function_calls = []
+                stream = await self.chat.send_message_stream(message=message, config=config)
+                async for chunk in stream:
+                    last_chunk = chunk
+                    if chunk.function_calls:
+                        function_calls.extend(chunk.function_calls)
+                    text = _chunk_text(chunk)
+                    if text:
+                        sys.stdout.write(text)
+                        sys.stdout.flush()
+                        text_parts.append(text)
+                # Automatic function calling is disabled, so answer the model's
+                # function calls ourselves until it replies in text.
+                if not function_calls:
+                    break
+                if tool_round < MAX_TOOL_ROUNDS:
+                    message = await self._call_tools(function_calls)
+                elif tool_round == MAX_TOOL_ROUNDS:
+                    # Like the SDK, don't run calls past the limit, but still
+                    # answer each one, then have the model reply without tools
+                    print(f"\n⚠️ Tool-round limit ({MAX_TOOL_ROUNDS}) reached; "
+                          f"skipping {len(function_calls)} further tool call(s).")
+                    message = [
+                        types.Part.from_function_response(
+                            name=call.name,
+                            response={"error": "not executed: tool-round limit reached"})
+                        for call in function_calls
+                    ]
+                    config = self._no_function_calling_config()
+                else:
+                    raise RuntimeError(
+                        "Model kept calling tools after the tool-round limit.")
+        except BaseException:
+            self.chat = self.client.aio.chats.create(
+                model=self.model_name, history=history_before)
+            raise
+        sys.stdout.write("\n")
+        sys.stdout.flush()
+        if not text_parts:
+            return last_chunk, None
+        content = {"role": "model", "parts": [{"text": "".join(text_parts)}]}
+        return last_chunk, content
+
+    async def _summarize_and_restart(self):
+        """Replaces the chat with a short summary of itself once it nears the context limit."""
+        print("\n⏳ Conversation is nearing the context limit, summarizing...")
+        # Summarize out of band so a failed or tool-calling reply leaves the
+        # live chat untouched. Tools stay declared because the history holds
+        # function calls, but mode NONE keeps the model from calling them.
+        contents = self.chat.get_history(curated=True) + [
+            types.Content(parts=[types.Part(text=SUMMARY_PROMPT)], role="user")]
+        config = types.GenerateContentConfig(
+            tools=[self.tool],
+            tool_config=types.ToolConfig(
+                function_calling_config=types.FunctionCallingConfig(mode="NONE")),
+            automatic_function_calling=types.AutomaticFunctionCallingConfig(
+                disable=True))
+        try:
+            response = await self.client.aio.models.generate_content(
+                model=self.model_name, contents=contents, config=config)
+            summary = response.text
+        except Exception as e:
+            print(f"\n⚠️ Could not summarize conversation: {e}")
+            return
+        if not summary:
+            print("\n⚠️ Summary was empty, keeping the full conversation.")
+            return
+        history = [
+            {"role": "user", "parts": [
+                {"text": f"Summary of our conversation so far:\n{summary}"}]},
+            {"role": "model", "parts": [{"text": "Understood. Let's continue."}]},
+        ]
+        self.chat = self.client.aio.chats.create(
+            model=self.model_name, history=history)
+        for content in self.conversation_history:
+            self._forget_content_tokens(content)
+        self.conversation_history = history
+        usage = response.usage_metadata
+        self.current_token_count = (usage.candidates_token_count or 0) if usage else 0
+        print("✅ Conversation summarized.")
+
+    def run_batch(self, prompts: list[str]) -> list[str]:
+        """Submits independent prompts as one inline batch job and returns the replies."""
+        inline_requests = [
+            {"contents": [types.Content(parts=[types.Part(text=p)], role="user")]}
+            for p in prompts
+        ]
+        batch = self.client.batches.create(
+            model=self.model_name, src=inline_requests)
+        print(f"\n⏳ Submitted batch job {batch.name} ({len(prompts)} prompts)...")
+        while batch.state.name not in BATCH_DONE_STATES:
+            time.sleep(BATCH_POLL_INTERVAL)
+            batch = self.client.batches.get(name=batch.name)
+        if batch.state.name != "JOB_STATE_SUCCEEDED":
+            raise RuntimeError(
+                f"Batch job {batch.name} ended in state {batch.state.name}: {batch.error}")
+        replies = []
+        for inline_response in batch.dest.inlined_responses:
+            if inline_response.response:
+                replies.append(inline_response.response.text or "")
+            else:
+                replies.append(f"Error: {inline_response.error}")
+        return replies
+
+    async def _warm_up_connection(self):
+        """Opens the async client's connection while the user types the first prompt."""
+        try:
+            await self.client.aio.models.count_tokens(
+                model=self.model_name,
+                contents=[{"role": "user", "parts": [{"text": "."}]}]
+            )
+        except Exception:
+            pass  # Only a latency optimization; the first real call will retry
+
+    async def start_interaction(self):
         if not self.client:
             print("\n❌ Client not configured. Exiting.")
             return
         print("\n⚒️ Initializing chat session...")
         try:
-            self.chat = self.client.chats.create(
+            self.chat = self.client.aio.chats.create(
                 model=self.model_name, history=[])
             print("✅ Chat session initialized.")
         except Exception as e:
             print(f"❌ Error initializing chat session: {e}")
             traceback.print_exc()
             sys.exit(1)
+        self._warm_up_task = asyncio.create_task(self._warm_up_connection())
         print("\n⚒️ Agent ready. Ask me anything. Type 'exit' to quit.")
-        tool_config = types.GenerateContentConfig(tools=self.tool_functions)
         while True:
             try:
                 prompt_text = f"\n🔵 You ({self.current_token_count}): "
-                user_input = input(prompt_text).strip()
+                user_input = (await _read_input(prompt_text)).strip()
                 if user_input.lower() in ["exit", "quit"]:
                     print("\n👋 Goodbye!")
                     break
                 if not user_input:
                     continue
                 # Add user message to manual history BEFORE sending
-                new_user_content = types.Content(
-                    parts=[types.Part(text=user_input)], role="user")
-                self.conversation_history.append(new_user_content)
+                self.conversation_history.append(
+                    {"role": "user", "parts": [{"text": user_input}]})
                 print("\n⏳ Sending message and processing...")
-                response = self.chat.send_message(
-                    message=user_input,
-                    config=tool_config
-                )
+                self._prune_history()
+                await self._refresh_prompt_cache()
+                response, agent_response_content = await self._stream_reply(
+                    user_input, self.tool_config)
                 # Add agent response to manual history AFTER getting it
-                agent_response_content = None
-                if response.candidates and response.candidates[0].content:
-                    agent_response_content = response.candidates[0].content
+                if agent_response_content:
                     self.conversation_history.append(agent_response_content)
                 else:
                     print(
                         "\n⚠️ Agent response did not contain content for history/counting.")
-                print(f"\n🟢 \x1b[92mAgent:\x1b[0m {response.text}")
-                # Calculate and store token count for the next prompt
-                try:
-                    token_count_response = self.client.models.count_tokens(
-                        model=self.model_name,
-                        contents=self.conversation_history
-                    )
-                    self.current_token_count = token_count_response.total_tokens
-                except Exception as count_error:
-                    print(f"\n⚠️ Could not update token count: {count_error}")
-            except KeyboardInterrupt:
+                # Update token count for the next prompt from the usage the
+                # SDK already returned; only fall back to a count_tokens
+                # round-trip when usage metadata is missing.
+                usage = getattr(response, 'usage_metadata', None)
+                if usage and usage.total_token_count:
+                    self.current_token_count = usage.total_token_count
+                else:
+                    try:
+                        counts = await asyncio.gather(
+                            *(self._count_content_tokens(content)
+                              for content in self.conversation_history))
+                        self.current_token_count = sum(counts)
+                    except Exception as count_error:
+                        print(f"\n⚠️ Could not update token count: {count_error}")
+                if self.current_token_count > SUMMARIZE_THRESHOLD * MODEL_CONTEXT_LIMIT:
+                    await self._summarize_and_restart()
+            except (KeyboardInterrupt, asyncio.CancelledError):
                 print("\n👋 Goodbye!")
                 break
             except Exception as e:
@@ -103,10 +521,29 @@ class CodeAgent:
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Gemini code agent")
+    parser.add_argument(
+        "--batch", metavar="FILE",
+        help="run each non-empty line of FILE as an independent prompt via the Batch API")
+    args = parser.parse_args()
     print("🚀 Starting Code Agent...")
     api_key = os.environ.get('GOOGLE_API_KEY')
     if not api_key:
         print("❌ GOOGLE_API_KEY environment variable not set.")
         sys.exit(1)
     agent = CodeAgent(api_key=api_key, model_name=MODEL_NAME)
-    agent.start_interaction()
+    try:
+        if args.batch:
+            prompts = [line.strip() for line in Path(args.batch).read_text(
+                encoding='utf-8').splitlines() if line.strip()]
+            try:
+                replies = agent.run_batch(prompts)
+            except Exception as e:
+                print(f"❌ Batch run failed: {e}")
+                sys.exit(1)
+            for prompt, reply in zip(prompts, replies):
+                print(f"\n🔵 You: {prompt}\n🟢 \x1b[92mAgent:\x1b[0m {reply}")
+        else:
+            asyncio.run(agent.start_interaction())
+    finally:
+        agent.close()
@@ -1,44 +1,118 @@
+import atexit
 import os
+import shlex
+import stat
 import subprocess
+import tempfile
+import threading
 from pathlib import Path
+from typing import Optional
 
 # Define project root as the directory containing this file
 project_root = Path(__file__).resolve().parent
+_ROOT_STR = str(project_root)
+
+# Process umask, read once at import (os.umask can only be read by setting it)
+_UMASK = os.umask(0)
+os.umask(_UMASK)
+
+# Cache of file contents keyed by resolved path -> (mtime_ns, size, text).
+# Entries are only served while the file's mtime and size are unchanged.
+_READ_CACHE_MAX = 128
+_READ_CACHE: dict[str, tuple[int, int, str]] = {}
+# Tools may run concurrently on worker threads; guards eviction in _cache_put
+_READ_CACHE_LOCK = threading.Lock()
+
+
+def _cache_put(key: str, mtime_ns: int, size: int, text: str) -> None:
+    with _READ_CACHE_LOCK:
+        _READ_CACHE.pop(key, None)
+        if len(_READ_CACHE) >= _READ_CACHE_MAX:
+            # Dicts preserve insertion order, so this evicts the oldest entry
+            _READ_CACHE.pop(next(iter(_READ_CACHE)), None)
+        _READ_CACHE[key] = (mtime_ns, size, text)
+
+
+# Shared Docker client and one long-lived sandbox container per image, so
+# run_in_sandbox execs into a running container instead of creating one.
+_DOCKER_CLIENT = None
+_WARM_CONTAINERS: dict = {}
+_DOCKER_LOCK = threading.Lock()
+# Label on warm containers, valued with the owning process id, so containers
+# left behind by a session that died without running atexit can be removed
+_SANDBOX_LABEL = "coding-agent-sandbox"
+
+# Command prefixes execute_bash_command accepts; a tuple so str.startswith
+# can test them all in one call
+_WHITELIST = ("ls", "cat", "git add", "git status", "git commit", "git push")
 
 # Security helper
 
 
-def _is_safe_path(path_str: str) -> bool:
+def _safe_resolve(path_str: str) -> Optional[Path]:
+    """Resolves path_str against project_root, or returns None if it escapes it.
+
+    Never cached: a symlink created later would make a stale result point
+    outside the project.
+    """
     try:
-        target_path = (project_root / path_str).resolve()
-        return target_path.is_relative_to(project_root)
-    except Exception:
-        return False
+        target = os.path.realpath(os.path.join(_ROOT_STR, path_str))
+    except (OSError, ValueError):
+        return None
+    if target == _ROOT_STR or target.startswith(_ROOT_STR + os.sep):
+        return Path(target)
+    return None
 
 
 def read_file(path: str) -> str:
     """Reads the content of a file at the given relative path."""
-    if not _is_safe_path(path):
+    file_path = _safe_resolve(path)
+    if file_path is None:
         return f"Error: Access denied: Path '{path}' is outside the allowed directory."
-    file_path = (project_root / path).resolve()
-    if not file_path.is_file():
+    # One stat serves both the is-a-file check and the cache validation
+    try:
+        st = os.stat(file_path)
+    except OSError:
+        st = None
+    if st is None or not stat.S_ISREG(st.st_mode):
         return f"Error: Path '{path}' is not a file or does not exist."
     try:
-        return file_path.read_text(encoding='utf-8')
+        key = str(file_path)
+        cached = _READ_CACHE.get(key)
+        if cached and cached[0] == st.st_mtime_ns and cached[1] == st.st_size:
+            return cached[2]
+        # Read straight into a buffer sized from the stat above and decode
+        # once, instead of letting read() grow its buffer as it goes
+        buf = bytearray(st.st_size)
+        n = 0
+        with open(file_path, 'rb', buffering=0) as f, memoryview(buf) as view:
+            while n < st.st_size:
+                chunk = f.readinto(view[n:])
+                if not chunk:
+                    break
+                n += chunk
+        if n < st.st_size:
+            del buf[n:]  # File shrank since the stat
+        text = buf.decode('utf-8')
+        _cache_put(key, st.st_mtime_ns, st.st_size, text)
+        return text
     except Exception as e:
         return f"Error reading file '{path}': {e}"
 
 
 def list_files(directory: str = '.') -> str:
     """Lists files and directories within a given relative path."""
-    if not _is_safe_path(directory):
+    dir_path = _safe_resolve(directory)
+    if dir_path is None:
         return f"Error: Access denied: Path '{directory}' is outside the allowed directory."
-    dir_path = (project_root / directory).resolve()
     if not dir_path.is_dir():
         return f"Error: Path '{directory}' is not a directory."
     try:
-        items = [f.name + ('/' if f.is_dir() else '')
-                 for f in dir_path.iterdir()]
+        # DirEntry.is_dir() uses the file type from the directory read,
+        # so only symlinks need an extra stat
+        with os.scandir(dir_path) as entries:
+            items = [entry.name + ('/' if entry.is_dir() else '')
+                     for entry in entries]
         return f"Contents of '{directory}':\n" + "\n".join(items)
     except Exception as e:
         return f"Error listing directory '{directory}': {e}"
@@ -46,72 +120,191 @@ def list_files(directory: str = '.') -> str:
 
 def edit_file(path: str, content: str) -> str:
     """Writes content to a file at the given relative path, overwriting it."""
-    if not _is_safe_path(path):
+    file_path = _safe_resolve(path)
+    if file_path is None:
         return f"Error: Access denied: Path '{path}' is outside the allowed directory."
-    file_path = (project_root / path).resolve()
+    key = str(file_path)
+    data = content.encode('utf-8')
     try:
+        try:
+            old_st = os.stat(file_path)
+        except FileNotFoundError:
+            old_st = None
+        # Skip the write when the file already holds exactly this content
+        if old_st is not None and old_st.st_size == len(data):
+            cached = _READ_CACHE.get(key)
+            if cached and cached[0] == old_st.st_mtime_ns and cached[1] == old_st.st_size:
+                unchanged = cached[2] == content
+            else:
+                unchanged = file_path.read_bytes() == data
+            if unchanged:
+                return f"No change: '{path}' already has this content."
         file_path.parent.mkdir(parents=True, exist_ok=True)
-        file_path.write_text(content, encoding='utf-8')
+        _READ_CACHE.pop(key, None)
+        # Write to a temp file in the same directory and rename it over the
+        # target, so readers never observe a partially written file
+        fd, tmp_name = tempfile.mkstemp(
+            dir=file_path.parent, prefix=f".{file_path.name}.", suffix=".tmp")
+        try:
+            with os.fdopen(fd, 'wb') as tmp:
+                tmp.write(data)
+            # mkstemp creates files as 0600; give new files the mode a plain
+            # open() would have used, and keep an existing file's mode
+            if old_st is not None:
+                os.chmod(tmp_name, stat.S_IMODE(old_st.st_mode))
+            else:
+                os.chmod(tmp_name, 0o666 & ~_UMASK)
+            os.replace(tmp_name, file_path)
+        except BaseException:
+            os.unlink(tmp_name)
+            raise
+        new_st = os.stat(file_path)
+        _cache_put(key, new_st.st_mtime_ns, new_st.st_size, content)
         return f"Successfully wrote to '{path}'."
     except Exception as e:
         return f"Error writing to file '{path}': {e}"
 
 
 def execute_bash_command(command: str) -> str:
-    """Executes a whitelisted bash command in the project's root directory."""
-    whitelist = ["ls", "cat", "git add",
-                 "git status", "git commit", "git push"]
-    is_whitelisted = any(command.strip().startswith(prefix)
-                         for prefix in whitelist)
-    if not is_whitelisted:
+    """Executes a whitelisted command (ls, cat, git add/status/commit/push) in the project's root directory.
+
+    The command is run directly, not through a shell: there is no glob
+    expansion, and pipes, redirects, ';' and '&&' are not supported. Pass
+    explicit file names, one command per call.
+    """
+    if not command.strip().startswith(_WHITELIST):
         return f"Error: Command '{command}' is not allowed. Only specific commands (ls, cat, git add/status/commit/push) are permitted."
     try:
+        argv = shlex.split(command)
+    except ValueError as e:
+        return f"Error parsing command '{command}': {e}"
+    try:
+        # Run the program directly: no per-call shell startup, and shell
+        # metacharacters (;, &&, |, $()) cannot smuggle in extra commands.
         result = subprocess.run(
-            command,
-            shell=True,
+            argv,
+            shell=False,
             capture_output=True,
             text=True,
             cwd=project_root,
+            timeout=30,
             check=False
         )
         output = f"- stdout -\n{result.stdout}\n- stderr -\n{result.stderr}"
         if result.returncode != 0:
             output += f"\n- Command exited with code: {result.returncode} -"
         return output.strip()
+    except subprocess.TimeoutExpired:
+        return f"Error: Command '{command}' timed out after 30 seconds."
     except Exception as e:
         return f"Error executing command '{command}': {e}"
 
 
+def _get_docker():
+    """Returns the shared Docker client, connecting and pinging it only once."""
+    global _DOCKER_CLIENT
+    if _DOCKER_CLIENT is None:
+        import docker
+        client = docker.from_env()
+        client.ping()
+        _remove_stale_containers(client)
+        _DOCKER_CLIENT = client
+    return _DOCKER_CLIENT
+
+
+def _pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except (PermissionError, OSError):
+        return True
+    return True
+
+
+def _remove_stale_containers(client) -> None:
+    """Removes labelled sandbox containers whose owning agent process is gone."""
+    try:
+        containers = client.containers.list(
+            all=True, filters={"label": _SANDBOX_LABEL})
+    except Exception:
+        return
+    for container in containers:
+        owner = container.labels.get(_SANDBOX_LABEL, "")
+        if owner.isdigit() and _pid_alive(int(owner)):
+            continue
+        try:
+            container.remove(force=True)
+        except Exception:
+            pass
+
+
+def _get_warm_container(client, image: str):
+    """Returns a running sandbox container for image, starting one if needed."""
+    container = _WARM_CONTAINERS.get(image)
+    if container is None:
+        container = client.containers.run(
+            image=image,
+            command=["sleep", "infinity"],
+            working_dir="/app",
+            volumes={str(project_root): {'bind': '/app', 'mode': 'rw'}},
+            network_mode='none',
+            mem_limit='512m',
+            nano_cpus=1_000_000_000,
+            labels={_SANDBOX_LABEL: str(os.getpid())},
+            detach=True
+        )
+        _WARM_CONTAINERS[image] = container
+    return container
+
+
+@atexit.register
+def _remove_warm_containers() -> None:
+    for container in _WARM_CONTAINERS.values():
+        try:
+            container.remove(force=True)
+        except Exception:
+            pass
+    _WARM_CONTAINERS.clear()
+
+
 def run_in_sandbox(command: str, image: str = "python:3.11-slim") -> str:
     """Executes a command inside a sandboxed Docker container."""
     try:
-        import docker
-        from docker.errors import DockerException
+        from docker.errors import APIError, DockerException
     except ImportError:
         return "Error: docker Python package is not installed."
     try:
-        client = docker.from_env()
-        client.ping()
+        with _DOCKER_LOCK:
+            client = _get_docker()
     except DockerException as e:
         return f"Error: Docker connection failed: {e}\nPlease ensure Docker is running."
     except Exception as e:
         return f"Error: Could not connect to Docker: {e}"
     try:
-        container_output = client.containers.run(
-            image=image,
-            command=f"sh -c '{command}'",
-            working_dir="/app",
-            volumes={str(project_root): {'bind': '/app', 'mode': 'rw'}},
-            remove=True,
-            network_mode='none',
-            mem_limit='512m',
-            cpus=1,
-            detach=False,
-            stdout=True,
-            stderr=True
-        )
-        output_str = container_output.decode('utf-8').strip()
-        return f"- Container Output -\n{output_str}"
+        with _DOCKER_LOCK:
+            container = _get_warm_container(client, image)
+        try:
+            exit_code, output = container.exec_run(
+                ["sh", "-c", command], workdir="/app")
+        except APIError:
+            # The warm container was removed or stopped; start a fresh one
+            # and retry once
+            with _DOCKER_LOCK:
+                if _WARM_CONTAINERS.get(image) is container:
+                    del _WARM_CONTAINERS[image]
+                    try:
+                        container.remove(force=True)
+                    except Exception:
+                        pass
+                container = _get_warm_container(client, image)
+            exit_code, output = container.exec_run(
+                ["sh", "-c", command], workdir="/app")
+        output_str = output.decode('utf-8').strip()
+        result = f"- Container Output -\n{output_str}"
+        if exit_code != 0:
+            result += f"\n- Command exited with code: {exit_code} -"
+        return result
     except DockerException as e:
         error_msg = f"Docker error during sandbox execution: {e}"
         if "not found" in str(e).lower() or "no such image" in str(e).lower():